@@ -1,19 +1,27 @@
 import asyncio
 import hashlib
+import json
 import time
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import os
 import re
+import signal
+import threading
 import logging
-from datetime import datetime, timedelta
-from contextlib import contextmanager
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
 import httpx
-from bs4 import BeautifulSoup
+import orjson
+import xxhash
+from bs4 import BeautifulSoup, SoupStrainer
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.request import HTTPXRequest
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
+from telegram.ext import Application, AIORateLimiter, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, ConversationHandler, filters
 
 # ========== НАСТРОЙКИ ==========
 # Загрузка переменных окружения из .env файла
@@ -56,13 +64,40 @@ STATE_WAITING_GROUP = 1
 STATE_WAITING_TEACHER = 2
 STATE_WAITING_MAIN_GROUP = 3
 
-def get_main_keyboard():
-    """Создать главную клавиатуру"""
-    keyboard = [
+# Статичные клавиатуры собираем один раз на импорте: объекты разметки
+# неизменяемы, пересоздавать их на каждое сообщение незачем
+_MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [
         [KeyboardButton(BTN_SCHEDULE)],
         [KeyboardButton(BTN_GROUPS), KeyboardButton(BTN_OTHER)]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    ],
+    resize_keyboard=True
+)
+
+_SCHEDULE_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🎓 Моя группа", callback_data=CB_SHOW_MY_SCHEDULE)],
+    [InlineKeyboardButton("👨‍🏫 Поиск преподавателя", callback_data=CB_START_TEACHER_SEARCH)]
+])
+
+_GROUPS_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Добавить", callback_data=CB_ADD_GROUP),
+     InlineKeyboardButton("➖ Удалить", callback_data=CB_REMOVE_GROUP)],
+    [InlineKeyboardButton("🏠 Изменить основную", callback_data=CB_SET_MAIN_GROUP)]
+])
+
+_OTHER_MENU_KB_SUBSCRIBED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔕 Отписаться", callback_data=CB_UNSUBSCRIBE)],
+    [InlineKeyboardButton("ℹ️ Помощь", callback_data=CB_HELP)]
+])
+
+_OTHER_MENU_KB_UNSUBSCRIBED = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔔 Подписаться", callback_data=CB_SUBSCRIBE)],
+    [InlineKeyboardButton("ℹ️ Помощь", callback_data=CB_HELP)]
+])
+
+def get_main_keyboard():
+    """Главная клавиатура (собрана заранее)"""
+    return _MAIN_KEYBOARD
 
 # ========== ЛОГИРОВАНИЕ ==========
 logging.basicConfig(
@@ -75,28 +110,57 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Временное хранилище (кэш)
-available_groups = set()
-
 # ========== RATE LIMITING ==========
-user_last_request = {}  # {user_id: timestamp}
+# Ограниченный LRU вместо бесконечно растущего словаря:
+# старые записи вытесняются, память не течёт
+user_last_request = OrderedDict()  # {user_id: time.monotonic()}
+RATE_LIMIT_MAX_USERS = 10_000
+RATE_LIMIT_STALE = 60          # записи старше этого можно выбрасывать
+RATE_LIMIT_SWEEP_EVERY = 1024  # как часто запускать ленивую чистку
 
-def check_rate_limit(user_id, cooldown=3):
-    """Проверка rate limiting (защита от спама)"""
-    now = datetime.now()
+_rate_limit_lock = asyncio.Lock()
+_rate_limit_calls = 0
 
-    if user_id in user_last_request:
-        time_passed = (now - user_last_request[user_id]).total_seconds()
-        if time_passed < cooldown:
-            return False, cooldown - time_passed
+async def check_rate_limit(user_id, cooldown=3):
+    """Проверка rate limiting (защита от спама)"""
+    global _rate_limit_calls
+    now = time.monotonic()
+
+    # Лок делает проверку и запись атомарными: несколько апдейтов
+    # одного пользователя не проскочат между check и act
+    async with _rate_limit_lock:
+        prev = user_last_request.get(user_id)
+        if prev is not None:
+            time_passed = now - prev
+            if time_passed < cooldown:
+                return False, cooldown - time_passed
+
+        user_last_request[user_id] = now
+        user_last_request.move_to_end(user_id)
+        if len(user_last_request) > RATE_LIMIT_MAX_USERS:
+            user_last_request.popitem(last=False)
+
+        # Раз в RATE_LIMIT_SWEEP_EVERY вызовов выбрасываем устаревшие
+        # записи с головы LRU, не дожидаясь переполнения
+        _rate_limit_calls += 1
+        if _rate_limit_calls % RATE_LIMIT_SWEEP_EVERY == 0:
+            while user_last_request:
+                oldest_id, oldest_ts = next(iter(user_last_request.items()))
+                if now - oldest_ts < RATE_LIMIT_STALE:
+                    break
+                del user_last_request[oldest_id]
 
-    user_last_request[user_id] = now
     return True, 0
 
 # ========== ВАЛИДАЦИЯ ==========
 
+# Компилируем один раз при загрузке модуля; \Z вместо $,
+# чтобы не пропустить завершающий перевод строки
+_GROUP_NAME_RE = re.compile(r'^[А-Яа-яA-Za-z0-9\-]+\Z')
+
+@lru_cache(maxsize=512)
 def validate_group_name(group_name):
-    """Валидация названия группы"""
+    """Валидация названия группы (повторные проверки той же строки — из кэша)"""
     if not group_name:
         return False, "Название группы не может быть пустым"
 
@@ -107,17 +171,21 @@ def validate_group_name(group_name):
         return False, "Название группы слишком короткое (мин. 2 символа)"
 
     # Разрешены только буквы (русские/английские), цифры и дефис
-    if not re.match(r'^[А-Яа-яA-Za-z0-9\-]+$', group_name):
+    if not _GROUP_NAME_RE.match(group_name):
         return False, "Название группы может содержать только буквы, цифры и дефис"
 
     return True, None
 
 # ========== БАЗА ДАННЫХ ==========
 
+# Пул соединений: подключаемся один раз при старте вместо
+# TCP+TLS рукопожатия на каждый запрос к БД
+_pool = ThreadedConnectionPool(2, 20, DATABASE_URL, sslmode='require')
+
 @contextmanager
 def get_db():
-    """Контекстный менеджер для работы с PostgreSQL"""
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
+    """Контекстный менеджер для работы с PostgreSQL (соединение из пула)"""
+    conn = _pool.getconn()
     try:
         yield conn
         conn.commit()
@@ -125,7 +193,32 @@ def get_db():
         conn.rollback()
         raise e
     finally:
-        conn.close()
+        _pool.putconn(conn)
+
+@contextmanager
+def get_db_ro():
+    """Соединение из пула для чистых SELECT: без commit на выходе.
+
+    rollback в finally лишь закрывает открытый снапшот транзакции;
+    на чтениях это дешевле, чем холостой COMMIT в get_db().
+    """
+    conn = _pool.getconn()
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        _pool.putconn(conn)
+
+@contextmanager
+def bulk_db():
+    """Одна транзакция на пачку записей (миграции, массовый импорт).
+
+    Хелперы-мутаторы принимают conn=...: передайте им соединение из
+    этого контекста, и вся пачка зафиксируется одним COMMIT вместо
+    коммита на каждую запись.
+    """
+    with get_db() as conn:
+        yield conn
 
 def init_db():
     """Инициализация базы данных"""
@@ -161,17 +254,71 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
             )
         ''')
-        
+
+        # Последнее распарсенное расписание (одна строка):
+        # после рестарта бот отвечает из БД, а не скрейпит сайт заново
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schedule_cache (
+                id INT PRIMARY KEY,
+                data JSONB,
+                fetched_at TIMESTAMP
+            )
+        ''')
+
+        # Состояние фонового мониторинга (хэши групп с прошлого тика)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS monitor_state (
+                id INT PRIMARY KEY,
+                group_hashes JSONB,
+                updated_at TIMESTAMP
+            )
+        ''')
+
+        # Индекс под обратный поиск «кто отслеживает группу X»
+        # в get_subscribers_by_group; PK (user_id, group_name)
+        # покрывает только поиск по пользователю
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_extra_groups_group
+            ON user_extra_groups (group_name)
+        ''')
+
         logger.info("✅ База данных PostgreSQL инициализирована")
 
+async def db_call(func, *args):
+    """Выполнить синхронную функцию БД в пуле потоков.
+
+    Запрос к Postgres из async-обработчика иначе блокирует весь цикл
+    событий: пока идёт round-trip к БД, бот не отвечает никому.
+    """
+    return await asyncio.to_thread(func, *args)
+
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С БД ==========
 
+# Кэши горячих чтений: данные пользователя и статус подписки меняются
+# редко, а запрашиваются почти на каждом апдейте. Запись в БД
+# инвалидирует соответствующую запись кэша (write-through)
+_user_cache = TTLCache(maxsize=10_000, ttl=300)
+_sub_cache = TTLCache(maxsize=10_000, ttl=300)
+_extra_groups_cache = TTLCache(maxsize=10_000, ttl=60)
+
+# Эти функции выполняются через db_call (asyncio.to_thread), то есть
+# из нескольких потоков пула сразу, а cachetools не потокобезопасен:
+# параллельные запись и pop ломают внутреннее кольцо истечения TTLCache.
+# Все обращения к кэшам — только под этим замком
+_cache_lock = threading.Lock()
+
 def get_user(user_id):
     """Получить данные пользователя"""
-    with get_db() as conn:
+    with _cache_lock:
+        if user_id in _user_cache:
+            return _user_cache[user_id]
+    with get_db_ro() as conn:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         cursor.execute('SELECT * FROM users WHERE user_id = %s', (user_id,))
-        return cursor.fetchone()
+        user = cursor.fetchone()
+        with _cache_lock:
+            _user_cache[user_id] = user
+        return user
 
 def set_user_group(user_id, group_name):
     """Установить основную группу пользователя"""
@@ -185,6 +332,8 @@ def set_user_group(user_id, group_name):
                 updated_at = EXCLUDED.updated_at
         ''', (user_id, group_name))
 
+    with _cache_lock:
+        _user_cache.pop(user_id, None)
     logger.info(f"👥 Пользователь {user_id} установил группу: {group_name}")
 
 def get_user_group(user_id):
@@ -192,52 +341,118 @@ def get_user_group(user_id):
     user = get_user(user_id)
     return user['group_name'] if user else None
 
-def subscribe_user(user_id):
+def subscribe_user(user_id, conn=None):
     """Подписать пользователя на уведомления"""
-    with get_db() as conn:
+    with (nullcontext(conn) if conn is not None else get_db()) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO subscriptions (user_id) 
             VALUES (%s)
             ON CONFLICT (user_id) DO NOTHING
         ''', (user_id,))
+    with _cache_lock:
+        _sub_cache.pop(user_id, None)
 
-def unsubscribe_user(user_id):
+def unsubscribe_user(user_id, conn=None):
     """Отписать пользователя"""
-    with get_db() as conn:
+    with (nullcontext(conn) if conn is not None else get_db()) as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM subscriptions WHERE user_id = %s', (user_id,))
+    with _cache_lock:
+        _sub_cache.pop(user_id, None)
 
 def is_subscribed(user_id):
     """Проверить подписку"""
-    with get_db() as conn:
+    with _cache_lock:
+        if user_id in _sub_cache:
+            return _sub_cache[user_id]
+    with get_db_ro() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT 1 FROM subscriptions WHERE user_id = %s', (user_id,))
-        return cursor.fetchone() is not None
+        cursor.execute('SELECT EXISTS(SELECT 1 FROM subscriptions WHERE user_id = %s)', (user_id,))
+        subscribed = cursor.fetchone()[0]
+        with _cache_lock:
+            _sub_cache[user_id] = subscribed
+        return subscribed
 
-def get_all_subscribers():
-    """Получить список всех подписчиков"""
-    with get_db() as conn:
+def get_subscribers_by_group():
+    """Обратный индекс: group_name -> [user_id подписчиков]
+
+    Один запрос вместо get_user_all_groups() на каждого подписчика —
+    рассылка обходит только изменённые группы, а не всех пользователей.
+    """
+    with get_db_ro() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT user_id FROM subscriptions')
-        return [row[0] for row in cursor.fetchall()]
+        # Группировку делает сама БД: наружу выходит одна строка
+        # на группу с готовым массивом подписчиков
+        cursor.execute('''
+            SELECT group_name, array_agg(DISTINCT user_id)
+            FROM (
+                SELECT u.group_name, s.user_id
+                FROM subscriptions s
+                JOIN users u USING (user_id)
+                WHERE u.group_name IS NOT NULL
+                UNION ALL
+                SELECT eg.group_name, s.user_id
+                FROM subscriptions s
+                JOIN user_extra_groups eg USING (user_id)
+            ) AS pairs
+            GROUP BY group_name
+        ''')
+        return dict(cursor.fetchall())
 
 def get_stats():
     """Получить статистику бота"""
-    with get_db() as conn:
+    with get_db_ro() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM subscriptions')
-        total_subs = cursor.fetchone()[0]
+        # Оба счётчика одним запросом — один round trip вместо двух
+        cursor.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM subscriptions)
+        ''')
+        total_users, total_subs = cursor.fetchone()
         return {'total': total_users, 'subscribed': total_subs}
 
+def save_schedule_to_db(schedule):
+    """Сохранить последнее распарсенное расписание в БД (одна JSONB-строка)"""
+    try:
+        # groups_set не сохраняем: это производное от ключей groups,
+        # при загрузке он восстанавливается, а в JSONB только раздувал строку
+        payload = {k: v for k, v in schedule.items() if k != 'groups_set'}
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO schedule_cache (id, data, fetched_at)
+                VALUES (1, %s::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (id) DO UPDATE SET
+                    data = EXCLUDED.data,
+                    fetched_at = EXCLUDED.fetched_at
+            ''', (json.dumps(payload, ensure_ascii=False),))
+    except Exception as e:
+        logger.error(f"Ошибка сохранения расписания в БД: {e}")
+
+def load_schedule_from_db():
+    """Загрузить последнее сохранённое расписание (после рестарта или сбоя скрейпа)"""
+    try:
+        with get_db_ro() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT data FROM schedule_cache WHERE id = 1')
+            row = cursor.fetchone()
+            data = row[0] if row else None
+            if data and 'groups' in data:
+                # Набор групп в БД не хранится — восстанавливаем из ключей
+                data['groups_set'] = frozenset(data['groups'])
+            return data
+    except Exception as e:
+        logger.error(f"Ошибка чтения расписания из БД: {e}")
+        return None
+
 # ========== ДОПОЛНИТЕЛЬНЫЕ ГРУППЫ ==========
 
-def add_extra_group(user_id, group_name):
+def add_extra_group(user_id, group_name, conn=None):
     """Добавить дополнительную группу"""
     try:
-        with get_db() as conn:
+        with (nullcontext(conn) if conn is not None else get_db()) as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO user_extra_groups (user_id, group_name)
@@ -245,6 +460,8 @@ def add_extra_group(user_id, group_name):
                 ON CONFLICT DO NOTHING
             ''', (user_id, group_name))
             if cursor.rowcount > 0:
+                with _cache_lock:
+                    _extra_groups_cache.pop(user_id, None)
                 logger.info(f"➕ Пользователь {user_id} добавил доп. группу: {group_name}")
                 return True
             return False
@@ -252,9 +469,68 @@ def add_extra_group(user_id, group_name):
         logger.error(f"Ошибка при добавлении группы: {e}")
         return False
 
-def remove_extra_group(user_id, group_name):
-    """Удалить дополнительную группу"""
+# Результаты try_add_extra_group
+ADD_OK = 'ok'
+ADD_IS_MAIN = 'is_main'
+ADD_EXISTS = 'exists'
+ADD_LIMIT = 'limit'
+
+def try_add_extra_group(user_id, group_name):
+    """Добавить доп. группу, приняв решение одним SELECT + условным INSERT
+
+    Раньше обработчик /addgroup делал три отдельных запроса (лимит,
+    основная группа, вставка). Здесь всё необходимое читается одним
+    запросом, а INSERT выполняется только когда добавление разрешено.
+    """
     with get_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT
+                (SELECT group_name FROM users WHERE user_id = %s),
+                EXISTS(SELECT 1 FROM user_extra_groups
+                       WHERE user_id = %s AND group_name = %s),
+                (SELECT COUNT(*) FROM user_extra_groups WHERE user_id = %s)
+        ''', (user_id, user_id, group_name, user_id))
+        main_group, already_exists, extra_count = cursor.fetchone()
+
+        if main_group and main_group.upper() == group_name:
+            return ADD_IS_MAIN
+        if already_exists:
+            return ADD_EXISTS
+        if extra_count >= MAX_EXTRA_GROUPS:
+            return ADD_LIMIT
+
+        cursor.execute('''
+            INSERT INTO user_extra_groups (user_id, group_name)
+            VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+        ''', (user_id, group_name))
+        with _cache_lock:
+            _extra_groups_cache.pop(user_id, None)
+        logger.info(f"➕ Пользователь {user_id} добавил доп. группу: {group_name}")
+        return ADD_OK
+
+def bulk_add_extra_groups(user_id, groups):
+    """Добавить несколько доп. групп одним запросом (для импорта/миграций)
+
+    execute_values отправляет все строки одним INSERT вместо
+    цикла cursor.execute — на порядки быстрее при массовых вставках.
+    """
+    if not groups:
+        return
+    with get_db() as conn:
+        cursor = conn.cursor()
+        execute_values(cursor, '''
+            INSERT INTO user_extra_groups (user_id, group_name)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+        ''', [(user_id, g) for g in groups])
+    with _cache_lock:
+        _extra_groups_cache.pop(user_id, None)
+
+def remove_extra_group(user_id, group_name, conn=None):
+    """Удалить дополнительную группу"""
+    with (nullcontext(conn) if conn is not None else get_db()) as conn:
         cursor = conn.cursor()
         cursor.execute('''
             DELETE FROM user_extra_groups 
@@ -262,34 +538,41 @@ def remove_extra_group(user_id, group_name):
         ''', (user_id, group_name))
         deleted = cursor.rowcount > 0
         if deleted:
+            with _cache_lock:
+                _extra_groups_cache.pop(user_id, None)
             logger.info(f"➖ Пользователь {user_id} удалил доп. группу: {group_name}")
         return deleted
 
 def get_user_extra_groups(user_id):
     """Получить список доп. групп пользователя"""
-    with get_db() as conn:
+    with _cache_lock:
+        if user_id in _extra_groups_cache:
+            return _extra_groups_cache[user_id]
+    with get_db_ro() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT group_name FROM user_extra_groups WHERE user_id = %s', (user_id,))
-        return [row[0] for row in cursor.fetchall()]
+        groups = [row[0] for row in cursor.fetchall()]
+        with _cache_lock:
+            _extra_groups_cache[user_id] = groups
+        return groups
 
 def get_user_all_groups(user_id):
-    """Получить все группы пользователя (основная + дополнительные)"""
-    main_group = get_user_group(user_id)
-    extra_groups = get_user_extra_groups(user_id)
-    
-    all_groups = []
-    if main_group:
-        all_groups.append(main_group)
-    all_groups.extend(extra_groups)
-    
-    return all_groups
+    """Получить все группы пользователя (основная + дополнительные)
 
-def count_extra_groups(user_id):
-    """Подсчитать количество дополнительных групп пользователя"""
-    with get_db() as conn:
+    Один запрос с UNION ALL вместо двух отдельных SELECT —
+    вдвое меньше обращений к БД на горячем пути /today.
+    """
+    with get_db_ro() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM user_extra_groups WHERE user_id = %s', (user_id,))
-        return cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT group_name, 0 AS ord FROM users
+            WHERE user_id = %s AND group_name IS NOT NULL
+            UNION ALL
+            SELECT group_name, 1 FROM user_extra_groups
+            WHERE user_id = %s
+            ORDER BY ord, group_name
+        ''', (user_id, user_id))
+        return [row[0] for row in cursor.fetchall()]
 
 # ========== ПОИСК ПРЕПОДАВАТЕЛЯ ==========
 
@@ -297,7 +580,13 @@ def get_all_teachers(schedule_data):
     """Получить список всех преподавателей из расписания"""
     if not schedule_data or 'groups' not in schedule_data:
         return set()
-    
+
+    index = schedule_data.get('teachers_index')
+    if index is not None:
+        # Индекс построен при парсинге — оригинальное написание берём из пар
+        return {entries[0][1]['teacher'] for entries in index.values()}
+
+    # Расписание без индекса (например, отфильтрованное) — полный обход
     teachers = set()
     for group_name, pairs in schedule_data['groups'].items():
         for pair in pairs:
@@ -311,14 +600,23 @@ def search_teachers(query, schedule_data):
     Поиск преподавателей по запросу.
     Возвращает список полных имен преподавателей.
     """
-    all_teachers = get_all_teachers(schedule_data)
     query_lower = query.lower()
-    
+
+    lower_map = schedule_data.get('teachers_lower') if schedule_data else None
+    if lower_map is not None:
+        # Точное совпадение — прямой поиск по ключу
+        if query_lower in lower_map:
+            return [lower_map[query_lower]]
+        # Частичное совпадение по уже приведённым к нижнему регистру ключам
+        return sorted(orig for low, orig in lower_map.items() if query_lower in low)
+
+    all_teachers = get_all_teachers(schedule_data)
+
     # Точное совпадение
     exact_matches = [t for t in all_teachers if t.lower() == query_lower]
     if exact_matches:
         return exact_matches
-        
+
     # Частичное совпадение
     matches = [t for t in all_teachers if query_lower in t.lower()]
     return sorted(list(matches))
@@ -330,10 +628,19 @@ def find_teacher_schedule(teacher_name, schedule_data):
     """
     if not schedule_data or 'groups' not in schedule_data:
         return {}
-    
+
     result = {}
     teacher_lower = teacher_name.lower()
-    
+
+    index = schedule_data.get('teachers_index')
+    if index is not None:
+        # Обходим только уникальных преподавателей, а не все пары всех групп
+        for key, entries in index.items():
+            if teacher_lower in key:
+                for group_name, pair in entries:
+                    result.setdefault(group_name, []).append(pair)
+        return result
+
     for group_name, pairs in schedule_data['groups'].items():
         matching_pairs = []
         for pair in pairs:
@@ -341,10 +648,10 @@ def find_teacher_schedule(teacher_name, schedule_data):
             # Ищем точное совпадение или вхождение (если передано полное имя)
             if teacher and (teacher_lower == teacher.lower() or teacher_lower in teacher.lower()):
                 matching_pairs.append(pair)
-        
+
         if matching_pairs:
             result[group_name] = matching_pairs
-    
+
     return result
 
 def format_teacher_schedule(teacher_name, teacher_data, schedule_date):
@@ -352,164 +659,317 @@ def format_teacher_schedule(teacher_name, teacher_data, schedule_date):
     if not teacher_data:
         return f"😕 Преподаватель с фамилией *{teacher_name}* не найден в расписании на сегодня"
     
-    text = f"📅 *{schedule_date}*\n"
-    text += f"👨‍🏫 Расписание преподавателя: *{teacher_name}*\n\n"
-    
+    # join-список вместо text += в цикле: одна финальная аллокация
+    parts = [
+        f"📅 *{schedule_date}*\n",
+        f"👨‍🏫 Расписание преподавателя: *{teacher_name}*\n\n",
+    ]
+
     total_pairs = 0
     for group_name, pairs in sorted(teacher_data.items()):
-        text += f"👥 *{group_name}*\n"
+        parts.append(f"👥 *{group_name}*\n")
         for pair in pairs:
-            text += f"   📚 {pair['pair_number']} пара — {pair['subject']}\n"
+            parts.append(f"   📚 {pair['pair_number']} пара — {pair['subject']}\n")
             total_pairs += 1
-        text += "\n"
-    
-    text += f"_Всего пар: {total_pairs}_"
-    return text
+        parts.append("\n")
+
+    parts.append(f"_Всего пар: {total_pairs}_")
+    return "".join(parts)
 
 # ========== ПАРСИНГ ==========
 
-async def get_schedule(group_filter=None):
-    """Получить расписание всех групп"""
-    timestamp = int(time.time() * 1000)
-    url = f"http://lntrt.ru/schedule/daySchedule?_={timestamp}"
-    
-    headers = {
+# Все 12 месяцев: раньше список был захардкожен внутри цикла
+# и покрывал только ноябрь–март, из-за чего дата не находилась
+# большую часть учебного года
+_MONTHS_RU = (
+    'января', 'февраля', 'марта', 'апреля', 'мая', 'июня',
+    'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря'
+)
+
+# Строка с датой: первая строка текста, где встречается название
+# месяца. Одна мультистрочная регулярка вместо Python-цикла по строкам
+_DATE_LINE_RE = re.compile(
+    r'^.*(?:' + '|'.join(_MONTHS_RU) + r').*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Заголовок <th> похож на название группы: 3–15 символов,
+# есть и буква, и цифра (например «ИС-1-23»). Набор символов
+# намеренно не сужаем: в заголовках встречаются «ё», слэши
+# подгрупп («ТО-21/1»), точки — как в исходной двойной проверке
+_GROUP_TH_RE = re.compile(r'^(?=.*\d)(?=.*[^\W\d_]).{3,15}\Z')
+
+# Общий HTTP-клиент с keep-alive: TCP-соединение с сайтом расписания
+# переиспользуется между запросами вместо рукопожатия на каждый
+_http_client = httpx.AsyncClient(
+    headers={
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
         'X-Requested-With': 'XMLHttpRequest'
-    }
+    },
+    timeout=10,
+    # Пара тёплых соединений с длинным keep-alive: сайт опрашивается
+    # раз в CHECK_INTERVAL, короткий дефолтный expiry успевал истечь
+    limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=300),
+)
+
+# Из всей страницы парсеру нужны только таблицы и div с датой:
+# остальную разметку (шапку, меню, футер) не строим вовсе
+_PARSE_ONLY = SoupStrainer(['table', 'div'])
+
+def _parse_schedule_html(html, group_filter=None):
+    """Разобрать HTML расписания (CPU-работа, выполняется вне цикла событий)"""
+    # lxml — парсер на C, в разы быстрее встроенного html.parser
+    soup = BeautifulSoup(html, 'lxml', parse_only=_PARSE_ONLY)
+
+    # Дата
+    schedule_date = "Дата не указана"
+    date_div = soup.find('div', style=lambda s: s and 'width:980px' in s)
+    if date_div:
+        m = _DATE_LINE_RE.search(date_div.get_text())
+        if m:
+            schedule_date = m.group(0).strip()
+    
+    print(f"📅 Дата: {schedule_date}")
+    
+    # Таблица
+    table = soup.find('table', class_='border')
+    if not table:
+        print("❌ Таблица не найдена")
+        return None
     
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers, timeout=10)
-        
-        if not response.text or response.text.strip() == '':
-            print("⚠️ Пустой ответ")
-            return None
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        # Дата
-        schedule_date = "Дата не указана"
-        date_div = soup.find('div', style=lambda s: s and 'width:980px' in s)
-        if date_div:
-            date_text = date_div.get_text()
-            for line in date_text.split('\n'):
-                if any(month in line.lower() for month in ['ноября', 'декабря', 'января', 'февраля', 'марта']):
-                    schedule_date = line.strip()
-                    break
-        
-        print(f"📅 Дата: {schedule_date}")
-        
-        # Таблица
-        table = soup.find('table', class_='border')
-        if not table:
-            print("❌ Таблица не найдена")
-            return None
-        
-        rows = table.find_all('tr')
-        print(f"📊 Всего строк в таблице: {len(rows)}")
-        
-        # Парсинг всех блоков
-        schedule_by_group = {}
-        i = 0
-        block_number = 0
+    rows = table.find_all('tr')
+    print(f"📊 Всего строк в таблице: {len(rows)}")
+    
+    # Парсинг всех блоков
+    schedule_by_group = {}
+    # Обратный индекс: teacher.lower() -> [(группа, пара), ...]
+    # Строится один раз при парсинге, чтобы поиск преподавателя
+    # не обходил все группы и пары на каждый запрос
+    teachers_index = {}
+    # teacher.lower() -> оригинальное написание, чтобы при поиске
+    # не пересчитывать .lower() по всем преподавателям на каждый запрос
+    teachers_lower = {}
+    i = 0
+    block_number = 0
+    
+    while i < len(rows):
+        row = rows[i]
+        group_headers = row.find_all('th')
         
-        while i < len(rows):
-            row = rows[i]
-            group_headers = row.find_all('th')
+        if len(group_headers) > 0:
+            groups_in_block = []
             
-            if len(group_headers) > 0:
-                groups_in_block = []
+            for th in group_headers:
+                group_name = th.get_text(strip=True)
                 
-                for th in group_headers:
-                    group_name = th.get_text(strip=True)
-                    
-                    if group_name and 3 <= len(group_name) <= 15:
-                        has_digit = any(c.isdigit() for c in group_name)
-                        has_letter = any(c.isalpha() for c in group_name)
-                        
-                        if has_digit and has_letter:
-                            groups_in_block.append(group_name)
-                            available_groups.add(group_name)
+                # Один проход регулярки вместо двух Python-циклов
+                # по символам; длина зашита в сам шаблон
+                if group_name and _GROUP_TH_RE.match(group_name):
+                    groups_in_block.append(group_name)
+            
+            if len(groups_in_block) > 0:
+                block_number += 1
                 
-                if len(groups_in_block) > 0:
-                    block_number += 1
-                    
-                    print(f"  📋 Блок {block_number}: {len(groups_in_block)} групп: {groups_in_block}")
-                    
-                    for group_name in groups_in_block:
-                        if group_name not in schedule_by_group:
-                            schedule_by_group[group_name] = []
+                print(f"  📋 Блок {block_number}: {len(groups_in_block)} групп: {groups_in_block}")
+                
+                for group_name in groups_in_block:
+                    # При фильтре собираем только нужную группу,
+                    # не тратя память и время на остальные
+                    if group_filter is not None and group_name != group_filter:
+                        continue
+                    if group_name not in schedule_by_group:
+                        schedule_by_group[group_name] = []
+                
+                if i + 1 < len(rows):
+                    schedule_row = rows[i + 1]
+                    schedule_cells = schedule_row.find_all('td', recursive=False)
                     
-                    if i + 1 < len(rows):
-                        schedule_row = rows[i + 1]
-                        schedule_cells = schedule_row.find_all('td', recursive=False)
+                    for col_index, big_cell in enumerate(schedule_cells):
+                        if col_index >= len(groups_in_block):
+                            break
                         
-                        for col_index, big_cell in enumerate(schedule_cells):
-                            if col_index >= len(groups_in_block):
-                                break
+                        group_name = groups_in_block[col_index]
+                        if group_filter is not None and group_name != group_filter:
+                            continue
+                        inner_tables = big_cell.find_all('table', recursive=True)
+                        
+                        for inner_table in inner_tables:
+                            pair_number_th = inner_table.find('th')
+                            pair_number = pair_number_th.get_text(strip=True) if pair_number_th else '?'
                             
-                            group_name = groups_in_block[col_index]
-                            inner_tables = big_cell.find_all('table', recursive=True)
+                            content_td = inner_table.find('td', style=lambda s: s and 'overflow' in s)
                             
-                            for inner_table in inner_tables:
-                                pair_number_th = inner_table.find('th')
-                                pair_number = pair_number_th.get_text(strip=True) if pair_number_th else '?'
-                                
-                                content_td = inner_table.find('td', style=lambda s: s and 'overflow' in s)
-                                
-                                if content_td:
-                                    subject_text = content_td.get_text(separator=' ', strip=True)
-                                    teacher_small = content_td.find('small')
-                                    teacher = teacher_small.get_text(strip=True) if teacher_small else ''
-                                    
-                                    if teacher:
-                                        subject = subject_text.replace(teacher, '').strip()
-                                    else:
-                                        subject = subject_text
-                                    
-                                    if 'нет' in subject.lower() and len(subject) < 15:
-                                        continue
-                                    
-                                    schedule_by_group[group_name].append({
-                                        'pair_number': pair_number,
-                                        'subject': subject,
-                                        'teacher': teacher
-                                    })
-                        
-                        i += 2
-                    else:
-                        i += 1
+                            if content_td:
+                                # Сначала забираем <small> с преподавателем и убираем его
+                                # из дерева — get_text по ячейке сразу даёт предмет без
+                                # второго обхода и .replace (который мог зацепить
+                                # совпадение фамилии внутри названия предмета)
+                                teacher_small = content_td.find('small')
+                                teacher = teacher_small.get_text(strip=True) if teacher_small else ''
+                                if teacher_small:
+                                    teacher_small.extract()
+
+                                subject = content_td.get_text(separator=' ', strip=True)
+
+                                if 'нет' in subject.lower() and len(subject) < 15:
+                                    continue
+
+                                pair = {
+                                    'pair_number': pair_number,
+                                    'subject': subject,
+                                    'teacher': teacher
+                                }
+                                schedule_by_group[group_name].append(pair)
+                                if teacher:
+                                    teacher_lower = teacher.lower()
+                                    teachers_index.setdefault(teacher_lower, []).append((group_name, pair))
+                                    teachers_lower.setdefault(teacher_lower, teacher)
+                    
+                    i += 2
                 else:
                     i += 1
             else:
                 i += 1
-        
-        print(f"✅ Всего найдено групп: {len(schedule_by_group)}")
-        
-        result = {
-            'date': schedule_date,
-            'groups': schedule_by_group
-        }
-        
-        if group_filter:
-            if group_filter in schedule_by_group:
-                return {
-                    'date': result['date'],
-                    'groups': {group_filter: schedule_by_group[group_filter]}
-                }
-            else:
-                print(f"⚠️ Группа {group_filter} не найдена")
-                return None
-        
+        else:
+            i += 1
+    
+    print(f"✅ Всего найдено групп: {len(schedule_by_group)}")
+    
+    result = {
+        'date': schedule_date,
+        'groups': schedule_by_group,
+        # Неизменяемый набор групп этого дня для O(1)-проверок наличия;
+        # живёт вместе с расписанием и не копит устаревшие названия
+        'groups_set': frozenset(schedule_by_group),
+        # Счётчики пар по группам считаем один раз при парсинге,
+        # чтобы обзорный формат не обходил словарь расписания заново
+        'group_counts': {g: len(pairs) for g, pairs in schedule_by_group.items()},
+        'teachers_index': teachers_index,
+        'teachers_lower': teachers_lower
+    }
+
+    # Фильтрация уже произошла в цикле парсинга
+    if group_filter and group_filter not in schedule_by_group:
+        print(f"⚠️ Группа {group_filter} не найдена")
+        return None
+
+    return result
+
+
+# Хэш последнего HTML: если сайт вернул те же байты,
+# повторный парсинг не нужен
+_last_html_hash = None
+_last_parsed = None
+# Валидаторы последнего ответа сайта для условных GET-запросов
+_last_etag = None
+_last_modified = None
+
+async def get_schedule(group_filter=None):
+    """Получить расписание всех групп"""
+    global _last_html_hash, _last_parsed, _last_etag, _last_modified
+
+    timestamp = int(time.time() * 1000)
+    url = f"http://lntrt.ru/schedule/daySchedule?_={timestamp}"
+
+    try:
+        # Условный GET: если сервер отдаёт валидаторы, при неизменном
+        # расписании он ответит 304 без тела вместо полного HTML
+        headers = {}
+        if group_filter is None:
+            if _last_etag:
+                headers['If-None-Match'] = _last_etag
+            if _last_modified:
+                headers['If-Modified-Since'] = _last_modified
+
+        response = await _http_client.get(url, headers=headers)
+
+        if response.status_code == 304 and _last_parsed is not None:
+            return _last_parsed
+
+        if not response.text or response.text.strip() == '':
+            print("⚠️ Пустой ответ")
+            return None
+
+        html_hash = hashlib.blake2b(response.content, digest_size=16).digest()
+        if group_filter is None and html_hash == _last_html_hash and _last_parsed is not None:
+            return _last_parsed
+
+        # Парсинг — чистый CPU, уводим его в поток,
+        # чтобы не блокировать цикл событий
+        result = await asyncio.to_thread(_parse_schedule_html, response.text, group_filter)
+
+        if result is not None and group_filter is None:
+            _last_html_hash = html_hash
+            _last_parsed = result
+            _last_etag = response.headers.get('ETag')
+            _last_modified = response.headers.get('Last-Modified')
+            # Полное расписание сохраняем в БД, чтобы пережить рестарт
+            await db_call(save_schedule_to_db, result)
+
         return result
-        
+
     except Exception as e:
         print(f"❌ Ошибка парсинга: {e}")
         import traceback
         traceback.print_exc()
         return None
 
+# Кэш распарсенного расписания: повторные запросы пользователей
+# не должны каждый раз дёргать сайт и парсить HTML заново
+SCHEDULE_CACHE_TTL = 300  # 5 минут
+_schedule_cache = {'data': None, 'ts': 0.0}
+# Single-flight: при одновременных промахах кэша скрейпит только первый,
+# остальные ждут тот же future вместо собственного запроса к сайту
+_schedule_inflight = None
+
+async def get_schedule_cached():
+    """Получить расписание из кэша или обновить его (не чаще раза в TTL)"""
+    global _schedule_inflight
+
+    if time.time() - _schedule_cache['ts'] < SCHEDULE_CACHE_TTL:
+        return _schedule_cache['data']
+
+    if _schedule_inflight is not None:
+        return await _schedule_inflight
+
+    _schedule_inflight = asyncio.get_running_loop().create_future()
+    try:
+        data = await get_schedule()
+        if data is None:
+            # Скрейп не удался — отдаём последнюю сохранённую копию из БД
+            data = await db_call(load_schedule_from_db)
+        if data is not None:
+            _schedule_cache['data'] = data
+            _schedule_cache['ts'] = time.time()
+        _schedule_inflight.set_result(data)
+        return data
+    except Exception as e:
+        _schedule_inflight.set_exception(e)
+        raise
+    finally:
+        _schedule_inflight = None
+
+def format_schedule_one(schedule_date, group_name, items):
+    """Форматирование расписания одной группы по готовым значениям"""
+    if not items:
+        return f"📭 У группы *{group_name}* пар нет\n\n_(или все пары отменены)_"
+
+    parts = [
+        f"📅 *{schedule_date}*\n",
+        f"👥 Группа: *{group_name}*\n\n",
+    ]
+
+    for item in items:
+        parts.append(f"📚 *{item['pair_number']} пара*\n")
+        parts.append(f"   📖 {item['subject']}\n")
+
+        if item['teacher']:
+            parts.append(f"   👨‍🏫 _{item['teacher']}_\n")
+
+        parts.append("\n")
+
+    return "".join(parts)
+
 def format_schedule(schedule_data, group_name=None):
     """Форматирование расписания"""
     
@@ -518,37 +978,46 @@ def format_schedule(schedule_data, group_name=None):
     
     schedule_date = schedule_data.get('date', 'Дата не указана')
     groups_data = schedule_data.get('groups', {})
-    
-    if group_name and group_name in groups_data:
-        text = f"📅 *{schedule_date}*\n"
-        text += f"👥 Группа: *{group_name}*\n\n"
-        
-        items = groups_data[group_name]
-        
-        if not items:
-            return f"📭 У группы *{group_name}* пар нет\n\n_(или все пары отменены)_"
-        
-        for item in items:
-            pair_num = item['pair_number']
-            text += f"📚 *{pair_num} пара*\n"
-            text += f"   📖 {item['subject']}\n"
-            
-            if item['teacher']:
-                text += f"   👨‍🏫 _{item['teacher']}_\n"
-            
-            text += "\n"
-        
-        return text
-    
-    text = f"📅 *{schedule_date}*\n\n"
-    text += f"Найдено групп: {len(groups_data)}\n\n"
-    
-    for group, items in sorted(groups_data.items()):
-        active_pairs = len(items)
-        text += f"👥 *{group}*: {active_pairs} пар\n"
-    
-    text += "\n_Выбери свою группу: /setgroup_"
-    
+    groups_set = schedule_data.get('groups_set', groups_data.keys())
+
+    if group_name and group_name in groups_set:
+        return format_schedule_one(schedule_date, group_name, groups_data[group_name])
+
+    parts = [
+        f"📅 *{schedule_date}*\n\n",
+        f"Найдено групп: {len(groups_data)}\n\n",
+    ]
+
+    # Счётчики готовы ещё с парсинга; пересчитываем только для
+    # расписаний, сохранённых без этого поля
+    group_counts = schedule_data.get('group_counts')
+    if group_counts is None:
+        group_counts = {g: len(items) for g, items in groups_data.items()}
+
+    for group, count in sorted(group_counts.items()):
+        parts.append(f"👥 *{group}*: {count} пар\n")
+
+    parts.append("\n_Выбери свою группу: /setgroup_")
+
+    return "".join(parts)
+
+# Кэш готового Markdown по (дата, группа): пока расписание группы
+# не изменилось (хэш совпадает), текст не рендерится заново
+_rendered_cache = LRUCache(maxsize=500)
+
+def get_rendered_group(schedule, group_name):
+    """Получить текст расписания группы, переиспользуя кэш рендера"""
+    pairs = schedule['groups'][group_name]
+    group_hash = xxhash.xxh3_64_intdigest(orjson.dumps(pairs, option=orjson.OPT_SORT_KEYS))
+
+    key = (schedule.get('date'), group_name)
+    entry = _rendered_cache.get(key)
+    if entry is not None and entry[0] == group_hash:
+        return entry[1]
+
+    # Прямые аргументы вместо сборки одногруппового словаря-обёртки
+    text = format_schedule_one(schedule.get('date', 'Дата не указана'), group_name, pairs)
+    _rendered_cache[key] = (group_hash, text)
     return text
 
 async def send_long_message(update: Update, text: str, max_length: int = 4000):
@@ -558,30 +1027,36 @@ async def send_long_message(update: Update, text: str, max_length: int = 4000):
     if len(text) <= max_length:
         await message.reply_text(text, parse_mode='Markdown')
         return
-    
-    parts = []
-    current_part = ""
-    
-    for line in text.split('\n'):
-        if len(current_part) + len(line) + 1 > max_length:
-            parts.append(current_part)
-            current_part = line + '\n'
-        else:
-            current_part += line + '\n'
-    
-    if current_part:
-        parts.append(current_part)
-    
-    for i, part in enumerate(parts):
-        if i == 0:
-            await message.reply_text(part, parse_mode='Markdown')
+
+    # Шлём часть сразу, как только она набралась: первая уходит
+    # в Telegram, пока собираются следующие, без списка всех частей
+    chunk = []
+    chunk_len = 0
+    part_number = 0
+
+    async def flush():
+        nonlocal part_number
+        part_number += 1
+        body = '\n'.join(chunk)
+        if part_number == 1:
+            await message.reply_text(body, parse_mode='Markdown')
         else:
             await message.reply_text(
-                f"_(часть {i+1})_\n\n{part}", 
+                f"_(часть {part_number})_\n\n{body}",
                 parse_mode='Markdown'
             )
 
+    for line in text.split('\n'):
+        if chunk and chunk_len + len(line) + 1 > max_length:
+            await flush()
+            chunk = [line]
+            chunk_len = len(line) + 1
+        else:
+            chunk.append(line)
+            chunk_len += len(line) + 1
 
+    if chunk:
+        await flush()
 
 # ========== КОМАНДЫ ==========
 
@@ -591,7 +1066,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     
     # Регистрируем пользователя если его нет
-    set_user_group(user_id, None)
+    await db_call(set_user_group, user_id, None)
     
     await update.message.reply_text(
         f"👋 *Привет, {username}! Я бот расписания ЛНТ*\n\n"
@@ -612,7 +1087,7 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message or update.callback_query.message
 
     # Проверка rate limiting
-    allowed, wait_time = check_rate_limit(user_id, cooldown=5)
+    allowed, wait_time = await check_rate_limit(user_id, cooldown=5)
     if not allowed:
         await message.reply_text(
             f"⏱️ Подожди {int(wait_time)} сек. перед следующим запросом",
@@ -622,7 +1097,7 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Получаем все группы пользователя
-    all_groups = get_user_all_groups(user_id)
+    all_groups = await db_call(get_user_all_groups, user_id)
     
     if not all_groups:
         await message.reply_text(
@@ -634,8 +1109,8 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await message.reply_text("⏳ Загружаю расписание...")
 
-    # Получаем полное расписание один раз
-    schedule = await get_schedule()
+    # Получаем полное расписание один раз (из кэша, если он свежий)
+    schedule = await get_schedule_cached()
     
     if not schedule:
         await message.reply_text(
@@ -644,24 +1119,35 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Отправляем расписание для каждой группы отдельным сообщением
-    sent_count = 0
-    for group_name in all_groups:
-        if group_name in schedule.get('groups', {}):
-            group_schedule = {
-                'date': schedule['date'],
-                'groups': {group_name: schedule['groups'][group_name]}
-            }
-            text = format_schedule(group_schedule, group_name)
-            await send_long_message(update, text)
-            sent_count += 1
-        else:
-            await message.reply_text(
-                f"⚠️ Группа *{group_name}* не найдена в расписании\n"
-                "_Возможно, её нет на сегодня или название указано неверно_",
-                parse_mode='Markdown'
-            )
-    
+    # Отправляем расписание для каждой группы отдельным сообщением,
+    # но параллельно — иначе 5 групп это 5 последовательных запросов к Telegram
+    groups_set = schedule.get('groups_set', schedule.get('groups', {}).keys())
+    found_groups = [g for g in all_groups if g in groups_set]
+    missing_groups = [g for g in all_groups if g not in groups_set]
+
+    # Небольшой семафор, чтобы пачка отправок одного пользователя
+    # не упёрлась во flood-лимиты Telegram
+    send_sem = asyncio.Semaphore(3)
+
+    async def _send_guarded(coro):
+        async with send_sem:
+            return await coro
+
+    tasks = []
+    for group_name in found_groups:
+        tasks.append(_send_guarded(send_long_message(update, get_rendered_group(schedule, group_name))))
+    for group_name in missing_groups:
+        tasks.append(_send_guarded(message.reply_text(
+            f"⚠️ Группа *{group_name}* не найдена в расписании\n"
+            "_Возможно, её нет на сегодня или название указано неверно_",
+            parse_mode='Markdown'
+        )))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    sent_count = sum(
+        1 for res in results[:len(found_groups)] if not isinstance(res, Exception)
+    )
+
     if sent_count == 0:
         await message.reply_text(
             "📭 Расписание для ваших групп не найдено\n\n"
@@ -687,7 +1173,7 @@ async def setgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.warning(f"Невалидное название группы от {user_id}: {group}")
             return
 
-        set_user_group(user_id, group)
+        await db_call(set_user_group, user_id, group)
 
         await update.message.reply_text(
             f"✅ *Группа установлена: {group}*\n\n"
@@ -696,20 +1182,18 @@ async def setgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     else:
         await update.message.reply_text("⏳ Загружаю список групп...")
-        
-        schedule = await get_schedule()
+
+        schedule = await get_schedule_cached()
         
         if schedule and 'groups' in schedule:
             groups = sorted(schedule['groups'].keys())
-            
-            text = "📋 *Доступные группы:*\n\n"
-            
+
+            parts = ["📋 *Доступные группы:*\n\n"]
             for group in groups:
-                text += f"• `{group}`\n"
-            
-            text += f"\n💡 Пример: `/setgroup {groups[0]}`"
-            
-            await send_long_message(update, text)
+                parts.append(f"• `{group}`\n")
+            parts.append(f"\n💡 Пример: `/setgroup {groups[0]}`")
+
+            await send_long_message(update, "".join(parts))
         else:
             await update.message.reply_text(
                 "⚠️ Не удалось загрузить список групп.\n"
@@ -720,8 +1204,8 @@ async def setgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def mygroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать выбранную группу"""
     user_id = update.effective_user.id
-    group = get_user_group(user_id)
-    
+    group = await db_call(get_user_group, user_id)
+
     if group:
         await update.message.reply_text(
             f"👥 Твоя группа: *{group}*\n\n"
@@ -737,7 +1221,7 @@ async def mygroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Подписка на уведомления"""
     user_id = update.effective_user.id
-    subscribe_user(user_id)
+    await db_call(subscribe_user, user_id)
     
     await update.message.reply_text(
         "✅ *Подписка активирована!*\n\n"
@@ -749,7 +1233,7 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отписка"""
     user_id = update.effective_user.id
-    unsubscribe_user(user_id)
+    await db_call(unsubscribe_user, user_id)
     await update.message.reply_text("❌ Подписка отменена")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -790,7 +1274,7 @@ async def teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Проверка rate limiting
-    allowed, wait_time = check_rate_limit(user_id, cooldown=5)
+    allowed, wait_time = await check_rate_limit(user_id, cooldown=5)
     if not allowed:
         await update.message.reply_text(
             f"⏱️ Подожди {int(wait_time)} сек. перед следующим запросом",
@@ -811,8 +1295,8 @@ async def teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     teacher_name = ' '.join(context.args)
     
     await update.message.reply_text("⏳ Ищу преподавателя...")
-    
-    schedule = await get_schedule()
+
+    schedule = await get_schedule_cached()
     
     if not schedule:
         await update.message.reply_text(
@@ -878,38 +1362,35 @@ async def addgroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    # Проверка лимита
-    current_count = count_extra_groups(user_id)
-    if current_count >= MAX_EXTRA_GROUPS:
+    # Лимит, основная группа и вставка — одним походом в БД
+    result = await db_call(try_add_extra_group, user_id, group)
+
+    if result == ADD_LIMIT:
         await update.message.reply_text(
             f"❌ Достигнут лимит дополнительных групп ({MAX_EXTRA_GROUPS})\n\n"
             "Удали ненужную группу: `/removegroup ГРУППА`",
             parse_mode='Markdown'
         )
-        return
-    
-    # Проверка что это не основная группа
-    main_group = get_user_group(user_id)
-    if main_group and main_group.upper() == group:
+    elif result == ADD_IS_MAIN:
         await update.message.reply_text(
             f"⚠️ *{group}* уже установлена как основная группа",
             parse_mode='Markdown'
         )
-        return
-    
-    # Добавление
-    if add_extra_group(user_id, group):
-        extra_groups = get_user_extra_groups(user_id)
+    elif result == ADD_EXISTS:
         await update.message.reply_text(
-            f"✅ Группа *{group}* добавлена!\n\n"
-            f"📋 Доп. группы ({len(extra_groups)}/{MAX_EXTRA_GROUPS}):\n" +
-            '\n'.join([f"• `{g}`" for g in extra_groups]) +
-            "\n\nПроверь расписание: /today",
+            f"⚠️ Группа *{group}* уже добавлена",
             parse_mode='Markdown'
         )
     else:
+        extra_groups = await db_call(get_user_extra_groups, user_id)
+        # Генератор вместо промежуточного списка и одна сборка текста
         await update.message.reply_text(
-            f"⚠️ Группа *{group}* уже добавлена",
+            "".join((
+                f"✅ Группа *{group}* добавлена!\n\n",
+                f"📋 Доп. группы ({len(extra_groups)}/{MAX_EXTRA_GROUPS}):\n",
+                '\n'.join(f"• `{g}`" for g in extra_groups),
+                "\n\nПроверь расписание: /today",
+            )),
             parse_mode='Markdown'
         )
 
@@ -918,7 +1399,7 @@ async def removegroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     if not context.args:
-        extra_groups = get_user_extra_groups(user_id)
+        extra_groups = await db_call(get_user_extra_groups, user_id)
         if not extra_groups:
             await update.message.reply_text(
                 "📋 У тебя нет дополнительных групп\n\n"
@@ -928,17 +1409,19 @@ async def removegroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         await update.message.reply_text(
-            "➖ *Удалить дополнительную группу*\n\n"
-            "Твои доп. группы:\n" +
-            '\n'.join([f"• `{g}`" for g in extra_groups]) +
-            "\n\nПример: `/removegroup " + extra_groups[0] + "`",
+            "".join((
+                "➖ *Удалить дополнительную группу*\n\n",
+                "Твои доп. группы:\n",
+                '\n'.join(f"• `{g}`" for g in extra_groups),
+                f"\n\nПример: `/removegroup {extra_groups[0]}`",
+            )),
             parse_mode='Markdown'
         )
         return
     
     group = ' '.join(context.args).upper()
     
-    if remove_extra_group(user_id, group):
+    if await db_call(remove_extra_group, user_id, group):
         await update.message.reply_text(
             f"✅ Группа *{group}* удалена",
             parse_mode='Markdown'
@@ -949,87 +1432,73 @@ async def removegroup(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
-async def mygroups(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать все отслеживаемые группы"""
-    user_id = update.effective_user.id
-    
-    main_group = get_user_group(user_id)
-    extra_groups = get_user_extra_groups(user_id)
-    
-    text = "👥 *Твои группы:*\n\n"
-    
+def _render_groups_block(main_group, extra_groups):
+    """Собрать общий блок «основная + дополнительные группы»"""
+    # Собираем текст списком, а не конкатенацией строк в цикле
+    parts = []
+
     if main_group:
-        text += f"🏠 Основная: *{main_group}*\n"
+        parts.append(f"🏠 Основная: *{main_group}*\n")
     else:
-        text += "🏠 Основная: _не выбрана_\n"
-    
+        parts.append("🏠 Основная: _не выбрана_\n")
+
     if extra_groups:
-        text += f"\n📋 Дополнительные ({len(extra_groups)}/{MAX_EXTRA_GROUPS}):\n"
+        parts.append(f"\n📋 Дополнительные ({len(extra_groups)}/{MAX_EXTRA_GROUPS}):\n")
         for g in extra_groups:
-            text += f"• `{g}`\n"
+            parts.append(f"• `{g}`\n")
     else:
-        text += "\n_Дополнительных групп нет_\n"
-    
-    text += "\n*Управление:*\n"
-    text += "`/setgroup` — изменить основную\n"
-    text += "`/addgroup` — добавить доп.\n"
-    text += "`/removegroup` — удалить доп."
+        parts.append("\n_Дополнительных групп нет_\n")
+
+    return "".join(parts)
+
+async def mygroups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать все отслеживаемые группы"""
+    user_id = update.effective_user.id
     
-    await update.message.reply_text(text, parse_mode='Markdown')
+    main_group = await db_call(get_user_group, user_id)
+    extra_groups = await db_call(get_user_extra_groups, user_id)
+
+    parts = [
+        "👥 *Твои группы:*\n\n",
+        _render_groups_block(main_group, extra_groups),
+        "\n*Управление:*\n",
+        "`/setgroup` — изменить основную\n",
+        "`/addgroup` — добавить доп.\n",
+        "`/removegroup` — удалить доп.",
+    ]
+
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
 
 # ========== UI: ОБРАБОТЧИКИ ==========
 
 async def show_schedule_ui(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню расписания"""
     message = update.message or update.callback_query.message
-    keyboard = [
-        [InlineKeyboardButton("🎓 Моя группа", callback_data=CB_SHOW_MY_SCHEDULE)],
-        [InlineKeyboardButton("👨‍🏫 Поиск преподавателя", callback_data=CB_START_TEACHER_SEARCH)]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.reply_text("Выберите действие:", reply_markup=reply_markup)
+    await message.reply_text("Выберите действие:", reply_markup=_SCHEDULE_MENU_KB)
 
 async def show_groups_ui(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню управления группами"""
     user_id = update.effective_user.id
     message = update.message or update.callback_query.message
-    main_group = get_user_group(user_id)
-    extra_groups = get_user_extra_groups(user_id)
-    
-    text = "👥 *Управление группами*\n\n"
-    text += f"🏠 Основная: *{main_group or 'не выбрана'}*\n"
-    
-    if extra_groups:
-        text += f"📋 Дополнительные: {', '.join(extra_groups)}\n"
-    else:
-        text += "📋 Дополнительные: _нет_\n"
-        
-    keyboard = [
-        [InlineKeyboardButton("➕ Добавить", callback_data=CB_ADD_GROUP),
-         InlineKeyboardButton("➖ Удалить", callback_data=CB_REMOVE_GROUP)],
-        [InlineKeyboardButton("🏠 Изменить основную", callback_data=CB_SET_MAIN_GROUP)]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+    main_group = await db_call(get_user_group, user_id)
+    extra_groups = await db_call(get_user_extra_groups, user_id)
+
+    text = "👥 *Управление группами*\n\n" + _render_groups_block(main_group, extra_groups)
+
+    await message.reply_text(text, parse_mode='Markdown', reply_markup=_GROUPS_MENU_KB)
 
 async def show_other_ui(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню 'Прочее'"""
     user_id = update.effective_user.id
     message = update.message or update.callback_query.message
-    subscribed = is_subscribed(user_id)
+    subscribed = await db_call(is_subscribed, user_id)
     
     sub_text = "✅ Подписка активна" if subscribed else "❌ Подписка выключена"
-    sub_action = CB_UNSUBSCRIBE if subscribed else CB_SUBSCRIBE
-    sub_btn_text = "🔕 Отписаться" if subscribed else "🔔 Подписаться"
-    
+    reply_markup = _OTHER_MENU_KB_SUBSCRIBED if subscribed else _OTHER_MENU_KB_UNSUBSCRIBED
+
     text = "⚙️ *Прочее*\n\n"
     text += f"Статус подписки: {sub_text}\n"
-    
-    keyboard = [
-        [InlineKeyboardButton(sub_btn_text, callback_data=sub_action)],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data=CB_HELP)]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+
     await message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
 
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1052,174 +1521,368 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=get_main_keyboard()
         )
 
+async def _cb_teacher_search_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text(
+        "Для поиска преподавателя введите команду:\n`/teacher Фамилия`", parse_mode='Markdown'
+    )
+
+async def _cb_select_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    teacher_name = update.callback_query.data.replace(CB_SELECT_TEACHER_PREFIX, "")
+    schedule = await get_schedule_cached()
+    teacher_data = find_teacher_schedule(teacher_name, schedule)
+    schedule_date = schedule.get('date', 'Дата не указана')
+    text = format_teacher_schedule(teacher_name, teacher_data, schedule_date)
+    await send_long_message(update, text)
+
+async def _cb_add_group_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text(
+        "Для добавления группы введите:\n`/addgroup Группа`", parse_mode='Markdown'
+    )
+
+async def _cb_remove_group_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    extra_groups = await db_call(get_user_extra_groups, user_id)
+    if not extra_groups:
+        await query.message.reply_text("У вас нет дополнительных групп для удаления.")
+        return
+
+    keyboard = []
+    for group in extra_groups:
+        keyboard.append([InlineKeyboardButton(f"❌ {group}", callback_data=f"{CB_REMOVE_GROUP_PREFIX}{group}")])
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.message.reply_text("Выберите группу для удаления:", reply_markup=reply_markup)
+
+async def _cb_remove_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    group_to_remove = query.data.replace(CB_REMOVE_GROUP_PREFIX, "")
+    user_id = update.effective_user.id
+    if await db_call(remove_extra_group, user_id, group_to_remove):
+        await query.message.edit_text(f"✅ Группа {group_to_remove} удалена.")
+    else:
+        await query.message.edit_text(f"❌ Не удалось удалить группу {group_to_remove}.")
+
+async def _cb_set_main_group_hint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text(
+        "Для изменения основной группы введите:\n`/setgroup Группа`", parse_mode='Markdown'
+    )
+
+async def _cb_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await db_call(subscribe_user, update.effective_user.id)
+    # Обновляем сообщение чтобы показать новый статус
+    await show_other_ui(update, context)
+
+async def _cb_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await db_call(unsubscribe_user, update.effective_user.id)
+    # Обновляем сообщение чтобы показать новый статус
+    await show_other_ui(update, context)
+
+# Диспетчеризация точных callback_data по словарю — O(1) вместо
+# цепочки elif; префиксные callback'и проверяются отдельно ниже
+_CB_HANDLERS = {
+    CB_SHOW_MY_SCHEDULE: today,
+    CB_START_TEACHER_SEARCH: _cb_teacher_search_hint,
+    CB_TEACHER_SEARCH: _cb_teacher_search_hint,  # Старый callback, оставим для совместимости
+    CB_ADD_GROUP: _cb_add_group_hint,
+    CB_REMOVE_GROUP: _cb_remove_group_menu,
+    CB_SET_MAIN_GROUP: _cb_set_main_group_hint,
+    CB_SUBSCRIBE: _cb_subscribe,
+    CB_UNSUBSCRIBE: _cb_unsubscribe,
+    CB_HELP: help_command,
+}
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка inline-кнопок"""
     query = update.callback_query
     await query.answer()
-    
+
     data = query.data
-    
-    if data == CB_SHOW_MY_SCHEDULE:
-        await today(update, context)
 
-    elif data == CB_START_TEACHER_SEARCH:
-        await query.message.reply_text("Для поиска преподавателя введите команду:\n`/teacher Фамилия`", parse_mode='Markdown')
-    
-    elif data == CB_TEACHER_SEARCH:
-        # Старый callback, оставим для совместимости
-        await query.message.reply_text("Для поиска преподавателя введите команду:\n`/teacher Фамилия`", parse_mode='Markdown')
-    
+    handler = _CB_HANDLERS.get(data)
+    if handler is not None:
+        await handler(update, context)
     elif data.startswith(CB_SELECT_TEACHER_PREFIX):
-        teacher_name = data.replace(CB_SELECT_TEACHER_PREFIX, "")
-        schedule = await get_schedule()
-        teacher_data = find_teacher_schedule(teacher_name, schedule)
-        schedule_date = schedule.get('date', 'Дата не указана')
-        text = format_teacher_schedule(teacher_name, teacher_data, schedule_date)
-        await send_long_message(update, text)
+        await _cb_select_teacher(update, context)
+    elif data.startswith(CB_REMOVE_GROUP_PREFIX):
+        await _cb_remove_group(update, context)
 
-    elif data == CB_ADD_GROUP:
-        await query.message.reply_text("Для добавления группы введите:\n`/addgroup Группа`", parse_mode='Markdown')
-        
-    elif data == CB_REMOVE_GROUP:
-        user_id = update.effective_user.id
-        extra_groups = get_user_extra_groups(user_id)
-        if not extra_groups:
-            await query.message.reply_text("У вас нет дополнительных групп для удаления.")
-            return
-            
-        keyboard = []
-        for group in extra_groups:
-            keyboard.append([InlineKeyboardButton(f"❌ {group}", callback_data=f"{CB_REMOVE_GROUP_PREFIX}{group}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_text("Выберите группу для удаления:", reply_markup=reply_markup)
+# ========== МОНИТОРИНГ ==========
 
-    elif data.startswith(CB_REMOVE_GROUP_PREFIX):
-        group_to_remove = data.replace(CB_REMOVE_GROUP_PREFIX, "")
-        user_id = update.effective_user.id
-        if remove_extra_group(user_id, group_to_remove):
-            await query.message.edit_text(f"✅ Группа {group_to_remove} удалена.")
+# Сколько уведомлений может быть в полёте одновременно;
+# точный темп выдерживает AIORateLimiter
+NOTIFY_CONCURRENCY = 20
+
+# Заголовок уведомления об изменении расписания
+NOTIF_HEADER = "🔔 *РАСПИСАНИЕ ОБНОВЛЕНО!*\n\n"
+
+# Разделитель блоков, когда у пользователя изменилось несколько групп
+NOTIF_SEPARATOR = '\n\n━━━━━━━━━━\n\n'
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _build_notification_texts(rendered, groups):
+    """Склеить блоки изменённых групп пользователя в минимум сообщений.
+
+    Вместо отдельного сообщения на каждую группу — одно объединённое;
+    при превышении лимита Telegram режем по границам групп.
+    """
+    texts = []
+    current = []
+    current_len = len(NOTIF_HEADER)
+
+    for group in groups:
+        block = rendered[group]
+        extra = len(block) + (len(NOTIF_SEPARATOR) if current else 0)
+        if current and current_len + extra > TELEGRAM_MESSAGE_LIMIT:
+            texts.append(NOTIF_HEADER + NOTIF_SEPARATOR.join(current))
+            current = [block]
+            current_len = len(NOTIF_HEADER) + len(block)
         else:
-            await query.message.edit_text(f"❌ Не удалось удалить группу {group_to_remove}.")
+            current.append(block)
+            current_len += extra
+
+    if current:
+        texts.append(NOTIF_HEADER + NOTIF_SEPARATOR.join(current))
+    return texts
+
+# «Мёртвые» получатели: заблокировали бота или удалили аккаунт.
+# Повторные попытки откладываются с экспоненциальным бэкоффом,
+# чтобы не жечь 403-запросы к Telegram каждый тик
+DEAD_USER_BACKOFF_START = 3600        # час после первого Forbidden
+DEAD_USER_BACKOFF_MAX = 7 * 86400     # потолок — неделя
+_dead_users = {}  # user_id -> (monotonic-время следующей попытки, текущий бэкофф)
+
+def _is_dead_user(user_id, now):
+    """Проверить, не рано ли снова писать этому пользователю"""
+    entry = _dead_users.get(user_id)
+    return entry is not None and entry[0] > now
+
+def _mark_dead_user(user_id):
+    """Отложить следующую попытку отправки, удваивая бэкофф"""
+    prev = _dead_users.get(user_id)
+    backoff = min(prev[1] * 2, DEAD_USER_BACKOFF_MAX) if prev else DEAD_USER_BACKOFF_START
+    _dead_users[user_id] = (time.monotonic() + backoff, backoff)
+
+# Хэши групп с прошлого тика храним в БД (одна JSONB-строка, как
+# schedule_cache): диск Render эфемерный, а Postgres переживает
+# и рестарты, и редеплои — без стартовых штормов уведомлений
+def _load_previous_hashes():
+    """Загрузить хэши групп, сохранённые прошлым запуском"""
+    try:
+        with get_db_ro() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT group_hashes FROM monitor_state WHERE id = 1')
+            row = cursor.fetchone()
+            if not row or not row[0]:
+                return {}
+            return {group: int(h) for group, h in row[0].items()}
+    except Exception as e:
+        logger.error(f"Ошибка чтения хэшей мониторинга: {e}")
+        return {}
+
+def _save_previous_hashes(hashes):
+    """Сохранить хэши групп в БД"""
+    try:
+        with get_db() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO monitor_state (id, group_hashes, updated_at)
+                VALUES (1, %s::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (id) DO UPDATE SET
+                    group_hashes = EXCLUDED.group_hashes,
+                    updated_at = EXCLUDED.updated_at
+            ''', (json.dumps(hashes),))
+    except Exception as e:
+        logger.error(f"Ошибка сохранения хэшей мониторинга: {e}")
 
-    elif data == CB_SET_MAIN_GROUP:
-        await query.message.reply_text("Для изменения основной группы введите:\n`/setgroup Группа`", parse_mode='Markdown')
+# Попыток на одно сообщение при временных сбоях (429, таймауты сети)
+NOTIFY_MAX_ATTEMPTS = 4
 
-    elif data == CB_SUBSCRIBE:
-        subscribe_user(update.effective_user.id)
-        # Обновляем сообщение чтобы показать новый статус
-        await show_other_ui(update, context)
-        
-    elif data == CB_UNSUBSCRIBE:
-        unsubscribe_user(update.effective_user.id)
-        # Обновляем сообщение чтобы показать новый статус
-        await show_other_ui(update, context)
-        
-    elif data == CB_HELP:
-        await help_command(update, context)
+async def _send_one_with_retry(app, user_id, text):
+    """Отправить сообщение, пережидая 429 и сетевые сбои.
 
-# ========== МОНИТОРИНГ ==========
+    RetryAfter ждём ровно сколько попросил Telegram; на сетевых
+    ошибках — экспоненциальная пауза. Forbidden/BadRequest отдаём
+    вызывающему сразу: это постоянные ошибки (чат не найден, битая
+    разметка), повторы их не лечат, а разбирает их логика «мёртвых»
+    получателей выше. BadRequest — подкласс NetworkError, поэтому
+    его нужно явно пробросить до сетевой ветки.
+    """
+    for attempt in range(NOTIFY_MAX_ATTEMPTS - 1):
+        try:
+            return await app.bot.send_message(
+                chat_id=user_id,
+                text=text,
+                parse_mode='Markdown'
+            )
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after + 0.1)
+        except BadRequest:
+            raise
+        except NetworkError:
+            await asyncio.sleep(2 ** attempt)
+    # Последняя попытка — без подстраховки, ошибка уходит вызывающему
+    return await app.bot.send_message(
+        chat_id=user_id,
+        text=text,
+        parse_mode='Markdown'
+    )
+
+async def _send_notification(sem, app, user_id, texts):
+    """Отправить пользователю его уведомления под семафором"""
+    async with sem:
+        for text in texts:
+            await _send_one_with_retry(app, user_id, text)
+
+# Тихий тик — DEBUG; «жив ли мониторинг» подтверждаем INFO-сердцебиением
+# не чаще, чем раз в полчаса
+MONITOR_HEARTBEAT_INTERVAL = 1800
 
 async def monitor_schedule(app):
     """Фоновый мониторинг"""
-    previous_hashes = {}  # Словарь: {group_name: hash}
+    previous_hashes = await db_call(_load_previous_hashes)  # Словарь: {group_name: hash}
+    previous_schedule_hash = None  # Хэш всего расписания целиком
+    if previous_hashes:
+        logger.info(f"💾 Загружены хэши {len(previous_hashes)} групп с прошлого запуска")
+
+    # Явный флаг холодного старта вместо проверки previous_hashes
+    # на непустоту в цикле: если хэшей с прошлого запуска нет,
+    # первый тик только снимает снимок, не рассылая уведомления
+    first_tick = not previous_hashes
 
-    print("🔍 Мониторинг запущен...")
+    logger.info("🔍 Мониторинг запущен...")
+    last_heartbeat = time.monotonic()
 
     while True:
         try:
             schedule = await get_schedule()
 
             if schedule and 'groups' in schedule:
-                current_hashes = {}
-                changed_groups = []
-
-                # Вычисляем хэши для каждой группы
-                for group_name, group_schedule in schedule['groups'].items():
-                    group_hash = hashlib.sha256(str(group_schedule).encode()).hexdigest()
-                    current_hashes[group_name] = group_hash
-
-                    # Проверяем, изменилась ли группа
-                    if group_name in previous_hashes:
-                        if previous_hashes[group_name] != group_hash:
+                # Свежие данные мониторинга кладём в общий кэш,
+                # чтобы UI-обработчики не скрейпили сайт сами
+                _schedule_cache['data'] = schedule
+                _schedule_cache['ts'] = time.time()
+
+                # Один хэш всего расписания: если совпал с прошлым тиком,
+                # пер-групповое сравнение и рассылка не нужны вовсе
+                schedule_hash = xxhash.xxh3_64_intdigest(
+                    orjson.dumps(schedule['groups'], option=orjson.OPT_SORT_KEYS)
+                )
+                if schedule_hash != previous_schedule_hash:
+                    previous_schedule_hash = schedule_hash
+
+                    current_hashes = {}
+                    changed_groups = []
+
+                    # Вычисляем хэши для каждой группы.
+                    # xxh3 по канонической сериализации orjson: для детекции
+                    # изменений криптографический SHA-256 не нужен, а str(dict)
+                    # не гарантирует стабильный порядок ключей
+                    for group_name, group_schedule in schedule['groups'].items():
+                        payload = orjson.dumps(group_schedule, option=orjson.OPT_SORT_KEYS)
+                        group_hash = xxhash.xxh3_64_intdigest(payload)
+                        current_hashes[group_name] = group_hash
+
+                        # Проверяем, изменилась ли группа
+                        if group_name in previous_hashes:
+                            if previous_hashes[group_name] != group_hash:
+                                changed_groups.append(group_name)
+                        # Новая группа: уведомляем, только если это
+                        # не холодный старт
+                        elif not first_tick:
                             changed_groups.append(group_name)
-                    # Если группа новая (первый запуск или добавлена новая группа)
-                    elif previous_hashes:  # Не первый запуск
-                        changed_groups.append(group_name)
-
-                # Если есть изменения
-                if changed_groups:
-                    print(f"\n🔔 Обнаружены изменения в расписании!")
-                    print(f"📅 Дата: {schedule.get('date', 'Не указана')}")
-                    print(f"📝 Изменённые группы ({len(changed_groups)}):")
-
-                    for group in changed_groups:
-                        if group in schedule['groups']:
-                            pairs_count = len(schedule['groups'][group])
-                            print(f"   • {group}: {pairs_count} пар")
-
-                            # Детальная информация о парах
-                            for pair in schedule['groups'][group]:
-                                print(f"      - {pair['pair_number']} пара: {pair['subject']}")
-
-                    # Получаем всех подписчиков
-                    subscribers = get_all_subscribers()
-                    notified_count = 0
-                    notified_groups = {}
-
-                    # Отправляем уведомления только тем, у кого изменилась хотя бы одна группа
-                    # Отправляем уведомления только тем, у кого изменилась хотя бы одна группа
-                    for user_id in subscribers:
-                        try:
-                            # Получаем все группы пользователя (основная + дополнительные)
-                            user_groups = get_user_all_groups(user_id)
-                            
-                            # Находим пересечение групп пользователя и изменённых групп
-                            user_changed_groups = [g for g in user_groups if g in changed_groups]
-                            
-                            if not user_changed_groups:
+
+                    # Если есть изменения
+                    if changed_groups:
+                        # Одна запись вместо print на каждую группу и пару:
+                        # ленивое %s-форматирование, детали — только на DEBUG
+                        logger.info(
+                            "🔔 Изменения в расписании: дата=%s, групп=%d (%s)",
+                            schedule.get('date', 'Не указана'),
+                            len(changed_groups),
+                            ', '.join(changed_groups),
+                        )
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug(
+                                "Детали изменений: %s",
+                                {
+                                    g: [f"{p['pair_number']} пара: {p['subject']}"
+                                        for p in schedule['groups'][g]]
+                                    for g in changed_groups
+                                },
+                            )
+
+                        # Обратный индекс подписчиков по группам одним запросом
+                        subscribers_by_group = await db_call(get_subscribers_by_group)
+
+                        # Текст по каждой изменённой группе рендерим один раз,
+                        # а не заново для каждого подписчика этой группы
+                        rendered = {}
+                        for group in changed_groups:
+                            rendered[group] = get_rendered_group(schedule, group)
+
+                        # Инвертируем индекс: для каждого пользователя — список
+                        # его изменённых групп, чтобы слать одно объединённое
+                        # сообщение, а не K отдельных; пользователей на бэкоффе
+                        # пропускаем ещё до создания задач
+                        now = time.monotonic()
+                        user_changed = {}
+                        for user_group in changed_groups:
+                            for user_id in subscribers_by_group.get(user_group, ()):
+                                if _is_dead_user(user_id, now):
+                                    continue
+                                user_changed.setdefault(user_id, []).append(user_group)
+
+                        # Все отправки выполняем параллельно под семафором,
+                        # вместо последовательных await
+                        sem = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+                        tasks = []
+                        targets = []  # (user_id, группы) для подсчёта результатов
+
+                        for user_id, user_groups in user_changed.items():
+                            texts = _build_notification_texts(rendered, user_groups)
+                            tasks.append(_send_notification(sem, app, user_id, texts))
+                            targets.append((user_id, user_groups))
+
+                        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+                        notified_count = 0
+                        notified_groups = {}
+                        for (user_id, user_groups), res in zip(targets, results):
+                            if isinstance(res, Forbidden) or (
+                                isinstance(res, BadRequest) and 'chat not found' in str(res).lower()
+                            ):
+                                # Бот заблокирован или чат удалён —
+                                # откладываем следующую попытку с бэкоффом
+                                _mark_dead_user(user_id)
+                                logger.warning(f"🚫 Пользователь {user_id} недоступен, отложен: {res}")
                                 continue
-                            
-                            # Отправляем уведомление для каждой изменённой группы
-                            for user_group in user_changed_groups:
-                                if user_group in schedule['groups']:
-                                    group_schedule = {
-                                        'date': schedule['date'],
-                                        'groups': {user_group: schedule['groups'][user_group]}
-                                    }
-
-                                    text = "🔔 *РАСПИСАНИЕ ОБНОВЛЕНО!*\n\n"
-                                    text += format_schedule(group_schedule, user_group)
-
-                                    await app.bot.send_message(
-                                        chat_id=user_id,
-                                        text=text,
-                                        parse_mode='Markdown'
-                                    )
-                                    notified_count += 1
-
-                                    # Подсчитываем уведомления по группам
-                                    if user_group not in notified_groups:
-                                        notified_groups[user_group] = 0
-                                    notified_groups[user_group] += 1
-                        except Exception as e:
-                            print(f"⚠️ Не удалось отправить {user_id}: {e}")
-
-                    print(f"\n✅ Уведомлено пользователей: {notified_count}")
-                    if notified_groups:
-                        print("📊 По группам:")
-                        for group, count in notified_groups.items():
-                            print(f"   • {group}: {count} чел.")
-                    print()
-
-                previous_hashes = current_hashes
+                            if isinstance(res, Exception):
+                                logger.warning(f"⚠️ Не удалось отправить {user_id}: {res}")
+                                continue
+                            _dead_users.pop(user_id, None)
+                            notified_count += 1
+                            for user_group in user_groups:
+                                notified_groups[user_group] = notified_groups.get(user_group, 0) + 1
+
+                        logger.info(
+                            "✅ Уведомлено пользователей: %d; по группам: %s",
+                            notified_count, notified_groups,
+                        )
+
+                    previous_hashes = current_hashes
+                    first_tick = False
+                    await db_call(_save_previous_hashes, current_hashes)
             else:
-                print("📭 Расписание еще не опубликовано")
+                logger.debug("📭 Расписание еще не опубликовано")
 
-        except Exception as e:
-            print(f"❌ Ошибка мониторинга: {e}")
-            import traceback
-            traceback.print_exc()
+            now = time.monotonic()
+            if now - last_heartbeat >= MONITOR_HEARTBEAT_INTERVAL:
+                logger.info("💓 Мониторинг работает, изменений нет")
+                last_heartbeat = now
+
+        except Exception:
+            logger.exception("❌ Ошибка мониторинга")
 
         await asyncio.sleep(CHECK_INTERVAL)
 
@@ -1229,6 +1892,46 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     """Логирование ошибок"""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
+async def _health_server():
+    """Мини-HTTP-сервер для health-check Render прямо на event loop бота"""
+    async def handle(reader, writer):
+        # Достаточно прочитать запрос и ответить 200 — Render больше не нужно
+        try:
+            await reader.read(1024)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain\r\n"
+                b"Content-Length: 11\r\n"
+                b"Connection: close\r\n"
+                b"\r\n"
+                b"I am alive!"
+            )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    port = int(os.environ.get("PORT", 10000))
+    server = await asyncio.start_server(handle, '0.0.0.0', port)
+    print(f"🌍 Health-сервер запущен на порту {port}")
+    return server
+
+async def _keep_alive():
+    """Периодический self-ping, чтобы Render не усыплял сервис"""
+    while True:
+        await asyncio.sleep(600)  # 10 минут
+        try:
+            url = os.environ.get("RENDER_EXTERNAL_URL")
+            if not url:
+                port = int(os.environ.get("PORT", 10000))
+                url = f"http://127.0.0.1:{port}"
+
+            await _http_client.get(url)
+            print(f"⏰ Keep-alive ping to {url}")
+        except Exception as e:
+            print(f"⚠️ Keep-alive failed: {e}")
+
 async def main_async():
     """Асинхронная главная функция"""
     print("🤖 Запуск бота...")
@@ -1242,8 +1945,10 @@ async def main_async():
     print(f"🔔 Подписчиков: {stats['subscribed']}")
     
     # Настройка запросов с увеличенными таймаутами
+    # Пул побольше, чтобы при параллельной рассылке уведомлений
+    # соединения к api.telegram.org не становились узким местом
     request = HTTPXRequest(
-        connection_pool_size=8,
+        connection_pool_size=64,
         read_timeout=20.0,
         write_timeout=20.0,
         connect_timeout=20.0,
@@ -1251,7 +1956,15 @@ async def main_async():
     )
     
     # Создание приложения
-    app = Application.builder().token(TOKEN).request(request).build()
+    # AIORateLimiter сам выстраивает исходящие сообщения под лимиты
+    # Telegram (30 сообщений/сек на бота), чтобы не ловить 429
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3))
+        .build()
+    )
     app.add_error_handler(error_handler)
     
     # Команды
@@ -1276,23 +1989,83 @@ async def main_async():
     print("✅ Бот запущен!")
     print(f"📊 Интервал проверки: {CHECK_INTERVAL // 60} минут")
     
+    # Режим доставки апдейтов определяем заранее: в webhook-режиме
+    # единственный публично проброшенный порт (на Render это $PORT)
+    # занимает сам вебхук. Отдельный health-сервер на нём не поднять —
+    # он отвечал бы Telegram заглушкой «I am alive!» вместо бота,
+    # а на другом порту наружу не виден
+    webhook_url = os.environ.get('WEBHOOK_URL')
+
+    # Health-check и keep-alive живут на том же event loop,
+    # отдельные потоки для них больше не нужны
+    health_server = None
+    if not webhook_url:
+        health_server = await _health_server()
+    # Ссылку на задачу храним по той же причине, что и monitor_task
+    # ниже: задачу без ссылок может собрать GC
+    keep_alive_task = asyncio.create_task(_keep_alive())
+
     # Инициализация и запуск
     async with app:
-        # Запускаем мониторинг как фоновую задачу
-        asyncio.create_task(monitor_schedule(app))
+        # Запускаем мониторинг как фоновую задачу. Ссылку храним:
+        # задачу без ссылок event loop может собрать GC, а её
+        # исключение никто бы не увидел — бот молча остался бы
+        # без уведомлений
+        monitor_task = asyncio.create_task(monitor_schedule(app))
+
+        def _log_monitor_death(task):
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("💀 Мониторинг упал", exc_info=task.exception())
+
+        monitor_task.add_done_callback(_log_monitor_death)
         # Запускаем polling
         await app.start()
-        await app.updater.start_polling(drop_pending_updates=True)
+        # Webhook вместо long-polling, если задан WEBHOOK_URL:
+        # Telegram пушит апдейты сам, без постоянных getUpdates.
+        # Без переменной (локальная разработка) остаётся polling
+        if webhook_url:
+            # Слушаем именно $PORT — на Render наружу маршрутизируется
+            # только он; WEBHOOK_PORT остаётся для других хостингов
+            await app.updater.start_webhook(
+                listen='0.0.0.0',
+                port=int(os.environ.get('PORT') or os.environ.get('WEBHOOK_PORT') or 8443),
+                url_path=TOKEN,
+                webhook_url=f"{webhook_url.rstrip('/')}/{TOKEN}",
+                secret_token=os.environ.get('WEBHOOK_SECRET'),
+                drop_pending_updates=True,
+            )
+            print(f"📡 Webhook-режим: {webhook_url}")
+        else:
+            await app.updater.start_polling(drop_pending_updates=True)
         
-        # Держим бота запущенным до прерывания
+        # Держим бота запущенным до сигнала остановки.
+        # Вместо цикла с sleep(1) ждём событие: процесс спит без
+        # ежесекундных пробуждений и завершается мгновенно по SIGTERM
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Windows: add_signal_handler не поддерживается,
+                # остановка по KeyboardInterrupt как раньше
+                pass
         try:
-            while True:
-                await asyncio.sleep(1)
+            await stop_event.wait()
         except asyncio.CancelledError:
             pass
         finally:
+            # Аккуратно гасим фоновые задачи до остановки приложения
+            monitor_task.cancel()
+            keep_alive_task.cancel()
+            await asyncio.gather(monitor_task, keep_alive_task, return_exceptions=True)
+            if health_server:
+                health_server.close()
+            await _http_client.aclose()
             await app.updater.stop()
             await app.stop()
+            # Возвращаем соединения пула Postgres при остановке
+            _pool.closeall()
 
 def main():
     """Главная функция"""
@@ -1305,40 +2078,6 @@ def main():
     
     # Запуск через asyncio.run() для Python 3.10+
     try:
-        # Запускаем dummy-сервер для Render
-        from http.server import HTTPServer, BaseHTTPRequestHandler
-        from threading import Thread
-        
-        class SimpleHandler(BaseHTTPRequestHandler):
-            def do_GET(self):
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"I am alive!")
-        
-        def run_server():
-            port = int(os.environ.get("PORT", 10000))
-            server = HTTPServer(('0.0.0.0', port), SimpleHandler)
-            print(f"🌍 Dummy server started on port {port}")
-            server.serve_forever()
-            
-        def keep_alive():
-            import time
-            while True:
-                time.sleep(600)  # 10 минут
-                try:
-                    url = os.environ.get("RENDER_EXTERNAL_URL")
-                    if not url:
-                        port = int(os.environ.get("PORT", 10000))
-                        url = f"http://127.0.0.1:{port}"
-                    
-                    httpx.get(url)
-                    print(f"⏰ Keep-alive ping to {url}")
-                except Exception as e:
-                    print(f"⚠️ Keep-alive failed: {e}")
-
-        Thread(target=run_server, daemon=True).start()
-        Thread(target=keep_alive, daemon=True).start()
-        
         asyncio.run(main_async())
     except KeyboardInterrupt:
         print("\n👋 Бот остановлен")